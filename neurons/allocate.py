@@ -18,23 +18,40 @@
 # DEALINGS IN THE SOFTWARE.
 
 import os
+import sys
+import glob
 import json
+import uuid
 import shutil
 import typing
 import sqlite3
+import pathlib
 import hashlib
 import argparse
+import tempfile
+import threading
 import subprocess
 import bittensor as bt
 import multiprocessing
+import multiprocessing.synchronize
 from datetime import datetime as dt
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 # Import this repository.
 from utils import check_version
 
 MIN_SIZE_IN_GB = 100
 CHUNK_SIZE = 1 << 22  # 4194304 (4 MB)
+VERIFY_MMAP_SIZE = 1 << 34  # 17179869184 (16 GB)
+# TB, GB, MB, KB thresholds in bytes.
+SIZE_THRESHOLDS = (1 << 40, 1 << 30, 1 << 20, 1 << 10)
+SIZE_UNITS = ("TB", "GB", "MB", "KB", "bytes")
+# Files SQLite keeps next to a database, they belong to the same hotkey as the database.
+SQLITE_SUFFIXES = ("-wal", "-shm", "-journal")
+RUST_SCRIPT_NAME = "storer_db_project"
+CARGO_DIRECTORY = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "generate_db", "target", "release"
+)
 
 
 def get_config() -> bt.config:
@@ -97,8 +114,7 @@ def get_config() -> bt.config:
         f"netuid{config.netuid}",
         "miner",
     )
-    if not os.path.exists(config.full_path):
-        os.makedirs(config.full_path, exist_ok=True)
+    os.makedirs(config.full_path, exist_ok=True)
 
     return config
 
@@ -117,6 +133,36 @@ def get_available_space(path: str) -> int:
     return stat.f_frsize * stat.f_bavail
 
 
+def delete_folders(paths: typing.List[str]):
+    """
+    Delete folders and their contents, ignoring errors.
+
+    Args:
+        - paths (typing.List[str]): The folder paths.
+    """
+    for path in paths:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def get_db_hotkey(filename: str, prefix: str) -> str:
+    """
+    Get the hotkey a DB file belongs to.
+
+    Args:
+        - filename (str): The name of the DB file, or of one of its SQLite files.
+        - prefix (str): The prefix of the DB files, before the hotkey.
+
+    Returns:
+        - str: The hotkey of the DB, the filename if it has no prefix.
+    """
+    for suffix in SQLITE_SUFFIXES:
+        if filename.endswith(suffix):
+            filename = filename[: -len(suffix)]
+            break
+
+    return filename[len(prefix) :] if filename.startswith(prefix) else filename
+
+
 def human_readable_size(size: int) -> str:
     """
     Convert a size in bytes to a human-readable format.
@@ -127,10 +173,7 @@ def human_readable_size(size: int) -> str:
     Returns:
         - str: Human-readable size.
     """
-    thresholds = [1 << 40, 1 << 30, 1 << 20, 1 << 10]  # GB, MB, KB thresholds in bytes
-    units = ["TB", "GB", "MB", "KB", "bytes"]
-
-    for threshold, unit in zip(thresholds, units):
+    for threshold, unit in zip(SIZE_THRESHOLDS, SIZE_UNITS):
         if size >= threshold:
             return f"{size / threshold:.2f} {unit}"
 
@@ -148,11 +191,12 @@ def confirm_generation(allocations: typing.List[dict]) -> bool:
         - bool: True if user confirms generation, False otherwise.
     """
     total_dbs = len(allocations)
-    total_size = sum([alloc["n_chunks"] * CHUNK_SIZE for alloc in allocations])
-    bt.logging.info(
-        f"Are you sure you want to partition {total_dbs} databases with total size {human_readable_size(total_size)}? (yes/no)"
+    total_size = sum(alloc["n_chunks"] for alloc in allocations) * CHUNK_SIZE
+    sys.stdout.write(
+        f"Are you sure you want to partition {total_dbs} databases with total size {human_readable_size(total_size)}? (yes/no) "
     )
-    return input().lower() in ['yes", "y']
+    sys.stdout.flush()
+    return input().strip().lower() in ("yes", "y")
 
 
 def allocate(
@@ -182,30 +226,69 @@ def allocate(
     )
 
     # Delete all DBs if restart flag is true.
+    deletion = None
     if restart:
         if os.path.exists(wallet_db_path):
             bt.logging.info(f"Restarting...")
             try:
-                shutil.rmtree(wallet_db_path)
+                # Move the folder aside, which is instant, and delete it in the background together with any leftover from a previous restart.
+                os.rename(wallet_db_path, f"{wallet_db_path}.old-{uuid.uuid4().hex}")
+                deletion = threading.Thread(
+                    target=delete_folders,
+                    args=(glob.glob(f"{glob.escape(wallet_db_path)}.old-*"),),
+                    daemon=True,
+                )
+                deletion.start()
                 bt.logging.info(
-                    f"Folder '{wallet_db_path}' and its contents successfully deleted."
+                    f"Folder '{wallet_db_path}' and its contents are being deleted."
                 )
 
-            except OSError as e:
-                bt.logging.error(f"Error: {e}")
+            except OSError:
+                try:
+                    shutil.rmtree(wallet_db_path)
+                    bt.logging.info(
+                        f"Folder '{wallet_db_path}' and its contents successfully deleted."
+                    )
+
+                except OSError as e:
+                    bt.logging.error(f"Error: {e}")
 
     # Create DB directory if not exists.
-    if not os.path.exists(
-        wallet_db_path
-    ):  # Ensure the wallet_db_path directory exists.
-        os.makedirs(wallet_db_path, exist_ok=True)
+    os.makedirs(wallet_db_path, exist_ok=True)
+
+    # Get the own hotkey from the wallet.
+    own_hotkey = wallet.hotkey.ss58_address
+    validator_hotkeys = [
+        hotkey
+        for hotkey, permit in zip(
+            metagraph.hotkeys, metagraph.validator_permit.tolist()
+        )
+        if permit
+    ]
+
+    # Walk the DB directory once: delete old databases whose hotkey is not registered and measure the size of the rest.
+    prefix = f"DB-{own_hotkey}-"
+    hotkey_set = frozenset(validator_hotkeys)
+    already_space = 0
+    with os.scandir(wallet_db_path) as entries:
+        for entry in entries:
+            if not entry.is_file(follow_symlinks=False):
+                continue
+
+            if get_db_hotkey(entry.name, prefix) not in hotkey_set:
+                os.unlink(entry.path)
+            else:
+                already_space += entry.stat(follow_symlinks=False).st_size
 
     # Calculate the filling space.
     available_space = get_available_space(wallet_db_path)
     desired_filling_space = size_in_gb * 1024 * 1024 * 1024
-    already_space = sum(
-        f.stat().st_size for f in os.scandir(wallet_db_path) if f.is_file()
-    )
+
+    # The old DBs still take space while they are being deleted, wait for them if the space is needed.
+    if desired_filling_space - already_space > available_space and deletion is not None:
+        bt.logging.info("Waiting for the old databases to be deleted...")
+        deletion.join()
+        available_space = get_available_space(wallet_db_path)
 
     if desired_filling_space - already_space <= available_space:
         filling_space = desired_filling_space
@@ -215,14 +298,6 @@ def allocate(
             f"Not enough space. Available: {human_readable_size(available_space)}. Desired: {human_readable_size(desired_filling_space)}"
         )
 
-    # Get the own hotkey from the wallet.
-    own_hotkey = wallet.hotkey.ss58_address
-    validator_hotkeys = [
-        hotkey
-        for i, hotkey in enumerate(metagraph.hotkeys)
-        if metagraph.validator_permit[i] > 0
-    ]
-
     # Calculate the size of the database for each hotkey.
     db_size = filling_space / len(validator_hotkeys)
 
@@ -230,9 +305,10 @@ def allocate(
     n_chunks = max(int(db_size / CHUNK_SIZE), 1)
 
     # Initialize an empty list to store the allocations.
+    db_path_prefix = os.path.join(wallet_db_path, prefix)
     allocations = [
         {
-            "db_path": os.path.join(wallet_db_path, f"DB-{own_hotkey}-{hotkey}"),
+            "db_path": db_path_prefix + hotkey,
             "n_chunks": n_chunks,
             "own_hotkey": own_hotkey,
             "hotkey": hotkey,
@@ -240,17 +316,61 @@ def allocate(
         for hotkey in validator_hotkeys
     ]
 
-    # Delete old database if hotkey is not registered.
-    for filename in os.listdir(wallet_db_path):
-        hotkey = filename.replace(f"DB-{own_hotkey}-", "")
-        if hotkey not in validator_hotkeys:
-            os.remove(os.path.join(wallet_db_path, filename))
-
     # Return the allocations list.
     bt.logging.trace(f"Allocations: {json.dumps(allocations, indent=4)}")
     return allocations
 
 
+def reuse_allocation(allocation: dict, hotkey: str) -> str:
+    """
+    Reuse the DB of an allocation for another hotkey. Every DB holds the same chain of chunks, only the file and table names depend on the hotkeys, so renaming both avoids generating the data again. The DB must not be open anywhere else.
+
+    Args:
+        - allocation (dict): A dictionary containing allocation details.
+        - hotkey (str): The hotkey that takes over the DB.
+
+    Returns:
+        - str: The new path of the DB.
+    """
+    db_path = os.path.join(
+        os.path.dirname(allocation["db_path"]),
+        f"DB-{allocation['own_hotkey']}-{hotkey}",
+    )
+
+    # Closing the only connection checkpoints the WAL file into the DB, so the DB is a single file again before it's moved.
+    connection = sqlite3.connect(allocation["db_path"])
+    try:
+        connection.execute(
+            f"ALTER TABLE DB{allocation['own_hotkey']}{allocation['hotkey']} RENAME TO DB{allocation['own_hotkey']}{hotkey}"
+        )
+        connection.commit()
+
+    finally:
+        connection.close()
+
+    # The SQLite files left next to the DB, if any, are moved with it and stale ones at the new path are deleted, so they are never applied to another DB.
+    os.replace(allocation["db_path"], db_path)
+    for suffix in SQLITE_SUFFIXES:
+        if os.path.exists(allocation["db_path"] + suffix):
+            os.replace(allocation["db_path"] + suffix, db_path + suffix)
+        elif os.path.exists(db_path + suffix):
+            os.remove(db_path + suffix)
+    return db_path
+
+
+def remove_db(db_path: str):
+    """
+    Delete a DB file together with the SQLite files next to it.
+
+    Args:
+        - db_path (str): Path to the DB file.
+    """
+    os.remove(db_path)
+    for suffix in SQLITE_SUFFIXES:
+        if os.path.exists(db_path + suffix):
+            os.remove(db_path + suffix)
+
+
 def generate(
     allocations: typing.List[dict],
     disable_prompt: bool = False,
@@ -259,7 +379,7 @@ def generate(
     capture_output: bool = True,
 ):
     """
-    This function is responsible for generating data and hashes DBs. It uses multi-threading to speed up the process.
+    This function is responsible for generating data and hashes DBs. It uses a single multi-threaded Rust process to speed up the process.
 
     Args:
         - allocations (typing.List[dict]): This is a list of dictionaries. Each dictionary contains details about an allocation.
@@ -272,29 +392,25 @@ def generate(
     if not disable_prompt and not confirm_generation(allocations=allocations):
         exit()
 
-    # Finally, we run the generation process. This is done using a ThreadPoolExecutor, which allows us to run multiple tasks concurrently.
-    with ThreadPoolExecutor(max_workers=workers) as executor:
-        for allocation in allocations:
-            executor.submit(run_rust_generate, allocation, only_hash, capture_output)
+    # Finally, we run the generation process. A single Rust process generates all the databases concurrently.
+    run_rust_generate_batch(allocations, only_hash, capture_output, workers)
 
 
-def run_rust_generate(
-    allocation: dict, only_hash: bool = False, capture_output: bool = True
-):
+def get_rust_command(
+    manifest_path: str, only_hash: bool = False, workers: int = 0
+) -> typing.List[str]:
     """
-    This function runs a Rust script to generate the data and hashes databases.
+    Build the command that runs the Rust script for a manifest of allocations.
 
     Args:
-        - allocation (dict): A dictionary containing allocation details.
+        - manifest_path (str): Path to the JSON file with the allocations to generate.
         - only_hash (bool): If True, only generate hash DB for validators.
-        - capture_output (bool): If True, no output is shown.
+        - workers (int): Number of databases generated concurrently. If 0, one per CPU thread.
+
+    Returns:
+        - typing.List[str]: The command and its arguments.
     """
-    # Get the directory containing the Rust script.
-    rust_script_name = "storer_db_project"
-    cargo_directory = os.path.join(
-        os.path.dirname(os.path.abspath(__file__)), "generate_db", "target", "release"
-    )
-    rust_executable = os.path.join(cargo_directory, rust_script_name)
+    rust_executable = os.path.join(CARGO_DIRECTORY, RUST_SCRIPT_NAME)
 
     # Check if Rust script is compiled.
     if not os.path.exists(rust_executable):
@@ -302,81 +418,194 @@ def run_rust_generate(
             "Rust executable not found. Please compile first (cargo build --release)."
         )
 
-    # Construct the command to run the Rust script. The command includes the path to the script, the path to the database, the number of chunks, the size of each chunk, and the table name for the database.
+    # Construct the command to run the Rust script. The command includes the path to the script, the path to the manifest and the number of workers.
     cmd = [
         rust_executable,
-        "--db_path",
-        allocation["db_path"],
-        "--n_chunks",
-        str(allocation["n_chunks"]),
-        "--chunk_size",
-        str(CHUNK_SIZE),
-        "--table_name",
-        f"{allocation['own_hotkey']}{allocation['hotkey']}",
+        "--manifest",
+        manifest_path,
+        "--workers",
+        str(workers),
     ]
 
     # If the hash flag is True, add the "--hash" option to the command.
     if only_hash:
         cmd.append("--only_hash")
 
-    # Run the command in the cargo directory. The output of the command is not captured.
-    result = subprocess.run(
-        cmd, cwd=cargo_directory, capture_output=capture_output, text=True
-    )
-
-    # If there is an error message in the output of the command, log an error message.
-    if result.stderr:
-        bt.logging.error(f"Failed to generate database: {allocation['db_path']}")
+    return cmd
 
 
-def verify(allocations):
+def run_rust_generate_batch(
+    allocations: typing.List[dict],
+    only_hash: bool = False,
+    capture_output: bool = True,
+    workers: int = multiprocessing.cpu_count(),
+):
     """
-    Verify the integrity of the generated data and hashes.
+    This function runs a Rust script to generate the data and hashes databases of several allocations at once.
 
     Args:
         - allocations (typing.List[dict]): This is a list of dictionaries. Each dictionary contains details about an allocation.
+        - only_hash (bool): If True, only generate hash DB for validators.
+        - capture_output (bool): If True, no output is shown.
+        - workers (int): Number of databases generated concurrently.
     """
-    for allocation in allocations:
-        if os.path.exists(allocation["db_path"]):
-            # Connect to the SQLite databases for data and hashes.
-            connection = sqlite3.connect(allocation["db_path"])
-            cursor = connection.cursor()
-
-            key = 0
-            while True:
-                # Fetch data from the database using the current key.
-                cursor.execute(
-                    f"SELECT data, hash FROM DB{allocation['own_hotkey']}{allocation['hotkey']} WHERE id = {key}"
+    if not allocations:
+        return
+
+    # Write the manifest with the databases to generate.
+    with tempfile.NamedTemporaryFile("w", suffix=".json") as manifest:
+        json.dump(
+            [
+                {
+                    "db_path": allocation["db_path"],
+                    "n_chunks": allocation["n_chunks"],
+                    "chunk_size": CHUNK_SIZE,
+                    "table_name": f"{allocation['own_hotkey']}{allocation['hotkey']}",
+                }
+                for allocation in allocations
+            ],
+            manifest,
+        )
+        manifest.flush()
+
+        # Run the command in the cargo directory. If the output is captured, stdout is discarded and stderr goes to a temporary file that is only read if the command fails.
+        with tempfile.TemporaryFile("w+") as stderr:
+            returncode = subprocess.call(
+                get_rust_command(manifest.name, only_hash, workers),
+                cwd=CARGO_DIRECTORY,
+                stdout=subprocess.DEVNULL if capture_output else None,
+                stderr=stderr if capture_output else None,
+            )
+
+            # If the command has failed, log an error message.
+            if returncode != 0:
+                stderr.seek(0)
+                bt.logging.error(
+                    f"Failed to generate databases: {', '.join(allocation['db_path'] for allocation in allocations)}. {stderr.read()}"
                 )
-                row = cursor.fetchone()
 
-                # If no data is found for the current key, exit the loop.
-                if not row:
-                    break
 
-                # Compute the hash of the fetched data.
-                computed_hash = hashlib.sha256(row[0].encode("utf8")).hexdigest()
+def run_rust_generate(
+    allocation: dict, only_hash: bool = False, capture_output: bool = True
+):
+    """
+    This function runs a Rust script to generate the data and hashes databases.
 
-                # Check if the computed hash matches the stored hash.
-                if computed_hash == row[1]:
-                    bt.logging.success(
-                        f"Hash match for key {key}! computed hash: {computed_hash}, stored hash: {row[1]}"
-                    )
+    Args:
+        - allocation (dict): A dictionary containing allocation details.
+        - only_hash (bool): If True, only generate hash DB for validators.
+        - capture_output (bool): If True, no output is shown.
+    """
+    run_rust_generate_batch([allocation], only_hash, capture_output, workers=1)
 
-                else:
-                    bt.logging.error(
-                        f"Hash mismatch for key {key}!, computed hash: {computed_hash}, stored hash: {row[1]}"
-                    )
-                    return
 
-                # Increment the key for the next iteration.
-                key += 1
+# Set in the verification workers, it tells them to stop when another allocation fails.
+verification_stop_event = None
 
-            # Log the successful verification of the data.
-            bt.logging.success(f"Verified {allocation['db_path']}.")
 
-            # Close the database connection.
+def init_verification_worker(stop_event: multiprocessing.synchronize.Event):
+    """
+    Initialize a verification worker process with the event that stops the verification.
+
+    Args:
+        - stop_event (multiprocessing.synchronize.Event): Event set when the verification must stop.
+    """
+    global verification_stop_event
+    verification_stop_event = stop_event
+
+
+def verify_allocation(allocation: dict) -> bool:
+    """
+    Verify the integrity of the generated data and hashes of a single allocation.
+
+    Args:
+        - allocation (dict): A dictionary containing allocation details.
+
+    Returns:
+        - bool: False if any stored hash doesn't match its data, True otherwise.
+    """
+    if not os.path.exists(allocation["db_path"]):
+        return True
+
+    # Connect to the SQLite databases for data and hashes. Verification never writes, so the file is opened read-only. It is not opened as immutable, that would skip the locking but also ignore rows still in the WAL file.
+    connection = sqlite3.connect(
+        f"{pathlib.Path(allocation['db_path']).resolve().as_uri()}?mode=ro", uri=True
+    )
+
+    # Memory-map the whole database (SQLite caps it to its compile-time maximum) so the kernel can read ahead on page faults, and enlarge the page cache, it reads every row once.
+    connection.execute("PRAGMA cache_size=-262144")
+    connection.execute(f"PRAGMA mmap_size={VERIFY_MMAP_SIZE}")
+
+    # Stream all the rows with a single query. The data is read as a BLOB so it is hashed without being decoded and encoded again.
+    cursor = connection.cursor()
+    cursor.execute(
+        f"SELECT id, CAST(data AS BLOB), hash FROM DB{allocation['own_hotkey']}{allocation['hotkey']} ORDER BY id"
+    )
+    for key, data, stored_hash in cursor:
+        # Another allocation already failed, the result of this one doesn't matter.
+        if verification_stop_event is not None and verification_stop_event.is_set():
             connection.close()
+            return False
+
+        # Compute the hash of the fetched data.
+        computed_hash = hashlib.sha256(data).hexdigest()
+
+        # Check if the computed hash matches the stored hash.
+        if computed_hash == stored_hash:
+            bt.logging.success(
+                f"Hash match for key {key}! computed hash: {computed_hash}, stored hash: {stored_hash}"
+            )
+
+        else:
+            bt.logging.error(
+                f"Hash mismatch for key {key}!, computed hash: {computed_hash}, stored hash: {stored_hash}"
+            )
+            connection.close()
+            return False
+
+    # Log the successful verification of the data.
+    bt.logging.success(f"Verified {allocation['db_path']}.")
+
+    # Close the database connection.
+    connection.close()
+    return True
+
+
+def verify(
+    allocations: typing.List[dict], workers: int = multiprocessing.cpu_count()
+) -> bool:
+    """
+    Verify the integrity of the generated data and hashes. Allocations are verified in parallel, each one in its own process.
+
+    Args:
+        - allocations (typing.List[dict]): This is a list of dictionaries. Each dictionary contains details about an allocation.
+        - workers (int): This is the number of concurrent workers that will be used for verification. By default, it's set to CPU threads.
+
+    Returns:
+        - bool: False if any allocation fails the verification, True otherwise.
+    """
+    if not allocations:
+        return True
+
+    # Each worker opens its own SQLite connection, so nothing is shared across processes but the event that stops them.
+    stop_event = multiprocessing.Event()
+    with ProcessPoolExecutor(
+        max_workers=min(len(allocations), workers),
+        initializer=init_verification_worker,
+        initargs=(stop_event,),
+    ) as executor:
+        futures = [
+            executor.submit(verify_allocation, allocation) for allocation in allocations
+        ]
+        for future in as_completed(futures):
+            if not future.result():
+                # Stop on the first mismatch: the pending allocations are not verified and the running ones stop at their next row, so the executor shuts down right away.
+                stop_event.set()
+                for pending in futures:
+                    pending.cancel()
+                return False
+
+    return True
 
 
 def main(config: bt.config):
@@ -417,7 +646,7 @@ def main(config: bt.config):
 
     # Verification.
     if not config.disable_verify:
-        verify(allocations)
+        verify(allocations, workers=config.workers)
 
 
 if __name__ == "__main__":
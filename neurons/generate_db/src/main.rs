@@ -4,6 +4,9 @@ extern crate indicatif;
 extern crate clap;
 extern crate rusqlite;
 extern crate log;
+extern crate rayon;
+extern crate serde;
+extern crate serde_json;
 
 use rusqlite::{Connection, params};
 use indicatif::{MultiProgress, ProgressBar, ProgressStyle};
@@ -11,6 +14,11 @@ use clap::{App, Arg};
 use sha2::{Sha256, Digest};
 use rand::{Rng, SeedableRng, rngs::StdRng};
 use rand::distributions::Alphanumeric;
+use rayon::prelude::*;
+use serde::Deserialize;
+
+// Number of chunks inserted per transaction.
+const CHUNKS_PER_TRANSACTION: usize = 16;
 
 struct ChunkGenerator {
     seed: [u8; 32],
@@ -68,52 +76,30 @@ impl ChunkGenerator {
     }
 }
 
-fn main() {
-    let matches = App::new("SQLite Chunk Generator")
-        .arg(Arg::with_name("db_path")
-            .long("db_path")
-            .value_name("DB_PATH")
-            .help("Path to the SQLite database.")
-            .required(true)
-            .takes_value(true))
-        .arg(Arg::with_name("n_chunks")
-            .long("n_chunks")
-            .value_name("N_CHUNKS")
-            .help("Number of chunks to generate.")
-            .required(true)
-            .takes_value(true))
-        .arg(Arg::with_name("chunk_size")
-            .long("chunk_size")
-            .value_name("CHUNK_SIZE")
-            .help("Size of each chunk in bytes.")
-            .required(true)
-            .takes_value(true))
-        .arg(Arg::with_name("table_name")
-            .long("table_name")
-            .value_name("TABLE_NAME")
-            .help("Table name for the database.")
-            .required(true)
-            .takes_value(true))
-        .arg(Arg::with_name("only_hash")
-            .long("only_hash")
-            .value_name("ONLY_HASH")
-            .help("Stores the hashes instead of the data itself.")
-            .required(false)
-            .takes_value(false))
-        .get_matches();
+#[derive(Deserialize)]
+struct Allocation {
+    db_path: String,
+    n_chunks: usize,
+    chunk_size: usize,
+    table_name: String
+}
 
-    env_logger::init();
+fn generate_db(allocation: &Allocation, only_hash: bool, pb: &ProgressBar) {
+    let db_path = allocation.db_path.as_str();
+    let n_chunks = allocation.n_chunks;
+    let chunk_size = allocation.chunk_size;
+    let table_name = allocation.table_name.as_str();
 
-    let db_path = matches.value_of("db_path").unwrap();
-    let n_chunks: usize = matches.value_of("n_chunks").unwrap().parse().expect("Failed to parse number of chunks");
-    let chunk_size: usize = matches.value_of("chunk_size").unwrap().parse().expect("Failed to parse chunk size");
-    let table_name = matches.value_of("table_name").unwrap();
-    let only_hash = matches.is_present("only_hash");
+    // Sanitize the seed value to ensure it's safe to use as a table name
+    if !table_name.chars().all(|c| c.is_ascii_alphanumeric() || c == '_') { panic!("Invalid characters in seed value."); }
 
     // Create a new SQLite connection
     let conn = Connection::open(db_path).expect("Failed to open database");
-    let _ = conn.execute("PRAGMA page_size=32768;", params![]); // set page_size to 32KB
+    let _ = conn.execute("PRAGMA page_size=65536;", params![]); // set page_size to 64KB, only applies to a new DB
     let _ = conn.execute("PRAGMA journal_mode=WAL", params![]);
+    let _ = conn.execute("PRAGMA cache_size=-65536", params![]); // 64MB page cache per DB, several DBs are generated in parallel
+    let _ = conn.execute("PRAGMA wal_autocheckpoint=10000", params![]); // checkpoint less often during bulk inserts
+    let _ = conn.execute("PRAGMA synchronous=NORMAL", params![]); // WAL is only synced on checkpoints
     let _ = conn.execute("PRAGMA auto_vacuum=FULL", params![]);
 
     let create_table_sql = format!(
@@ -125,19 +111,6 @@ fn main() {
     //log::info!("create_table_sql: {}", create_table_sql);
     conn.execute(&create_table_sql, params![]).expect("Failed to create DB table");
 
-    // Sanitize the seed value to ensure it's safe to use as a table name
-    if !table_name.chars().all(|c| c.is_ascii_alphanumeric() || c == '_') { panic!("Invalid characters in seed value."); }
-
-    // Set up the progress bar.
-    let multi = MultiProgress::new();
-    let pb = multi.add(ProgressBar::new(n_chunks as u64));
-    pb.set_style(ProgressStyle::default_bar()
-        .template("{spinner:.green} [{elapsed_precise}] [{bar:40.cyan/blue}] {pos}/{len} ({eta})")
-        .progress_chars("#>-"));
-
-    // This spawns a new thread for the progress bars
-    let _progress_thread_handle = std::thread::spawn(move || { multi.join().unwrap(); });
-
     // Get current state
     //log::info!("Preparing statement to fetch the latest RNG state from the database.");
 
@@ -169,29 +142,124 @@ fn main() {
         log::info!("Deleting excess rows up to id: {}", n_chunks);
         let delete_rows = format!("DELETE FROM DB{} WHERE id >= ?", table_name);
         conn.execute(&delete_rows, params![n_chunks as i64]).expect("Failed to delete excess rows");
+        pb.finish_and_clear();
 
     } else {
         // Initialize ChunkGenerator with the provided seed and chunk size
         let mut chunk_gen = ChunkGenerator::new(current_seed, chunk_size);
 
+        // Prepare the insert statement once and group the inserts in transactions, so each chunk doesn't pay its own commit.
+        let insert_sql = format!("INSERT INTO DB{} (id, data, hash) VALUES (?, ?, ?)", table_name);
+        let mut insert_stmt = conn.prepare(&insert_sql).expect("Failed to prepare statement");
+
         // Generate and store chunks
         pb.inc(start_index as u64);
+        conn.execute_batch("BEGIN").expect("Failed to begin transaction");
         for i in start_index..n_chunks {
             let (chunk_data, chunk_hash) = chunk_gen.next();
 
             // Store the id, data, hash
-            let insert_sql = format!("INSERT INTO DB{} (id, data, hash) VALUES (?, ?, ?)", table_name);
-            conn.execute(&insert_sql, params![i as i64, if only_hash { String::new() } else { String::from_utf8(chunk_data).unwrap() }, hex::encode(&chunk_hash)]).expect("Failed to insert into database");
+            insert_stmt.execute(params![i as i64, if only_hash { String::new() } else { String::from_utf8(chunk_data).unwrap() }, hex::encode(&chunk_hash)]).expect("Failed to insert into database");
             pb.inc(1);
+
+            // Commit every CHUNKS_PER_TRANSACTION chunks, so an interrupted generation can be resumed.
+            if (i + 1) % CHUNKS_PER_TRANSACTION == 0 {
+                conn.execute_batch("COMMIT; BEGIN").expect("Failed to commit transaction");
+            }
         };
+        conn.execute_batch("COMMIT").expect("Failed to commit transaction");
         pb.finish();
-
-        // Get current state
-        //log::info!("Finish");
-
-        // Wait for the progress bars to finish
-        _progress_thread_handle.join().unwrap();
     }
 
     if let Err(err) = conn.close() { eprintln!("Error closing the database connection: {:?}", err); }
 }
+
+fn main() {
+    let matches = App::new("SQLite Chunk Generator")
+        .arg(Arg::with_name("manifest")
+            .long("manifest")
+            .value_name("MANIFEST")
+            .help("Path to a JSON file with the list of databases to generate.")
+            .required(false)
+            .takes_value(true))
+        .arg(Arg::with_name("workers")
+            .long("workers")
+            .value_name("WORKERS")
+            .help("Number of databases to generate concurrently (0 = one per CPU).")
+            .required(false)
+            .default_value("0")
+            .takes_value(true))
+        .arg(Arg::with_name("db_path")
+            .long("db_path")
+            .value_name("DB_PATH")
+            .help("Path to the SQLite database.")
+            .required_unless("manifest")
+            .takes_value(true))
+        .arg(Arg::with_name("n_chunks")
+            .long("n_chunks")
+            .value_name("N_CHUNKS")
+            .help("Number of chunks to generate.")
+            .required_unless("manifest")
+            .takes_value(true))
+        .arg(Arg::with_name("chunk_size")
+            .long("chunk_size")
+            .value_name("CHUNK_SIZE")
+            .help("Size of each chunk in bytes.")
+            .required_unless("manifest")
+            .takes_value(true))
+        .arg(Arg::with_name("table_name")
+            .long("table_name")
+            .value_name("TABLE_NAME")
+            .help("Table name for the database.")
+            .required_unless("manifest")
+            .takes_value(true))
+        .arg(Arg::with_name("only_hash")
+            .long("only_hash")
+            .value_name("ONLY_HASH")
+            .help("Stores the hashes instead of the data itself.")
+            .required(false)
+            .takes_value(false))
+        .get_matches();
+
+    env_logger::init();
+
+    let workers: usize = matches.value_of("workers").unwrap().parse().expect("Failed to parse number of workers");
+    let only_hash = matches.is_present("only_hash");
+
+    // Read the databases to generate, either from the manifest or from the command line.
+    let allocations: Vec<Allocation> = match matches.value_of("manifest") {
+        Some(manifest_path) => {
+            let manifest = std::fs::read_to_string(manifest_path).expect("Failed to read manifest");
+            serde_json::from_str(&manifest).expect("Failed to parse manifest")
+        }
+        None => vec![Allocation {
+            db_path: matches.value_of("db_path").unwrap().to_string(),
+            n_chunks: matches.value_of("n_chunks").unwrap().parse().expect("Failed to parse number of chunks"),
+            chunk_size: matches.value_of("chunk_size").unwrap().parse().expect("Failed to parse chunk size"),
+            table_name: matches.value_of("table_name").unwrap().to_string()
+        }]
+    };
+
+    // Set up one progress bar per database.
+    let multi = MultiProgress::new();
+    let style = ProgressStyle::default_bar()
+        .template("{spinner:.green} [{elapsed_precise}] [{bar:40.cyan/blue}] {pos}/{len} ({eta})")
+        .progress_chars("#>-");
+    let bars: Vec<ProgressBar> = allocations.iter().map(|allocation| {
+        let pb = multi.add(ProgressBar::new(allocation.n_chunks as u64));
+        pb.set_style(style.clone());
+        pb
+    }).collect();
+
+    // This spawns a new thread for the progress bars
+    let _progress_thread_handle = std::thread::spawn(move || { multi.join().unwrap(); });
+
+    // Generate the databases in parallel, sharing a single thread pool.
+    let pool = rayon::ThreadPoolBuilder::new().num_threads(workers).build().expect("Failed to build thread pool");
+    pool.install(|| {
+        allocations.par_iter().zip(bars.par_iter()).for_each(|(allocation, pb)| generate_db(allocation, only_hash, pb));
+    });
+
+    // Wait for the progress bars to finish
+    _progress_thread_handle.join().unwrap();
+}
@@ -19,9 +19,13 @@
 
 import os
 import time
+import queue
+import asyncio
+import pathlib
 import hashlib
 import sqlite3
 import argparse
+import contextlib
 import traceback
 import threading
 import typing
@@ -31,11 +35,150 @@ import multiprocessing
 # Import this repo.
 import allocate
 import tensorage
-from utils import check_version, is_validator
+from utils import check_version, check_version_periodically, hash_data
 
 FAILED_KEY = -1
 STEP_TIME = 60
+VERSION_CHECK_TIME = 600
 MIN_SIZE_IN_GB = 100
+CACHE_SIZE_IN_KB = 16384
+MMAP_SIZE = 1 << 34
+MAX_READERS = 8
+
+
+def connect(db_path: str) -> sqlite3.Connection:
+    """
+    Open a SQLite connection to a DB that can be used from any thread.
+
+    Args:
+        - db_path (str): Path to the DB file.
+
+    Returns:
+        - sqlite3.Connection: SQLite connection.
+    """
+    # Autocommit mode, each store is a single UPDATE so it doesn't need an explicit transaction. The pool makes sure a connection is only used by one thread at a time. The DB is opened without being created, a DB that isn't generated yet must keep the page size set by the generator.
+    connection = sqlite3.connect(
+        f"{pathlib.Path(db_path).resolve().as_uri()}?mode=rw",
+        uri=True,
+        isolation_level=None,
+        check_same_thread=False,
+    )
+
+    # WAL lets retrieves read while a store or the generator writes, and with synchronous=NORMAL only checkpoints are synced. Rows are served through the memory map, so the page cache is kept modest, there is one connection per reader.
+    connection.executescript(
+        "PRAGMA journal_mode=WAL;"
+        "PRAGMA synchronous=NORMAL;"
+        "PRAGMA temp_store=MEMORY;"
+        f"PRAGMA cache_size=-{CACHE_SIZE_IN_KB};"
+        f"PRAGMA mmap_size={MMAP_SIZE};"
+    )
+    return connection
+
+
+class SqlitePool:
+    """
+    Pool of SQLite connections to a DB shared across threads: up to `size` reader connections, opened on demand, and a single writer connection. It also holds the queries on the DB table, built once so every request reuses the same SQL text.
+    """
+
+    def __init__(self, db_path: str, table_name: str, size: int):
+        self.db_path = db_path
+        self.select_sql = f"SELECT data FROM {table_name} WHERE id = ?"
+        self.update_sql = f"UPDATE {table_name} SET data = ?, hash = ? WHERE id = ?"
+        self.size = max(size, 1)
+        self.n_readers = 0
+        self.readers = queue.Queue()
+        self.lock = threading.Lock()
+        self.returned = threading.Condition(self.lock)
+        self.writer = None
+        self.write_lock = threading.Lock()
+        self.closed = False
+
+    @contextlib.contextmanager
+    def read(self) -> typing.Iterator[sqlite3.Connection]:
+        """
+        Borrow a reader connection, waiting for one to be returned if all of them are in use.
+
+        Returns:
+            - typing.Iterator[sqlite3.Connection]: SQLite connection.
+        """
+        try:
+            connection = self.readers.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                if self.closed:
+                    raise sqlite3.ProgrammingError("Cannot read from a closed pool.")
+                create = self.n_readers < self.size
+                if create:
+                    self.n_readers += 1
+            if not create:
+                connection = self.readers.get()
+            else:
+                try:
+                    connection = connect(self.db_path)
+                except sqlite3.Error:
+                    with self.lock:
+                        self.n_readers -= 1
+                        self.returned.notify_all()
+                    raise
+
+        # Closing the pool wakes up the waiting readers with None, which is passed on to the next one.
+        if connection is None:
+            self.readers.put(None)
+            raise sqlite3.ProgrammingError("Cannot read from a closed pool.")
+
+        try:
+            yield connection
+        finally:
+            # A connection borrowed while the pool was closed is closed on return.
+            with self.lock:
+                if self.closed:
+                    connection.close()
+                    self.n_readers -= 1
+                    self.returned.notify_all()
+                else:
+                    self.readers.put(connection)
+
+    @contextlib.contextmanager
+    def write(self) -> typing.Iterator[sqlite3.Connection]:
+        """
+        Hold the writer connection, writes to the DB are serialized.
+
+        Returns:
+            - typing.Iterator[sqlite3.Connection]: SQLite connection.
+        """
+        with self.write_lock:
+            if self.closed:
+                raise sqlite3.ProgrammingError("Cannot write to a closed pool.")
+            if self.writer is None:
+                self.writer = connect(self.db_path)
+            yield self.writer
+
+    def close(self):
+        """
+        Close all the connections, waiting for the borrowed readers to be returned, so the DB is not open anywhere once it returns. Reads and writes on the closed pool raise sqlite3.ProgrammingError.
+        """
+        with self.lock:
+            self.closed = True
+        with self.write_lock:
+            if self.writer is not None:
+                self.writer.close()
+                self.writer = None
+
+        with self.lock:
+            while True:
+                try:
+                    connection = self.readers.get_nowait()
+                except queue.Empty:
+                    break
+                if connection is not None:
+                    connection.close()
+                    self.n_readers -= 1
+
+            # Wake up the readers waiting for a connection, they fail instead of waiting forever.
+            self.readers.put(None)
+
+            while self.n_readers > 0:
+                self.returned.wait()
 
 
 def get_config() -> bt.config:
@@ -102,8 +245,7 @@ def get_config() -> bt.config:
         f"netuid{config.netuid}",
         "miner",
     )
-    if not os.path.exists(config.full_path):
-        os.makedirs(config.full_path, exist_ok=True)
+    os.makedirs(config.full_path, exist_ok=True)
 
     return config
 
@@ -136,6 +278,11 @@ def main(config: bt.config):
     metagraph = subtensor.metagraph(config.netuid)
     bt.logging.info(f"Metagraph: {metagraph}")
 
+    # Validator permit of each registered hotkey, rebuilt on every metagraph resync so the blacklist doesn't scan the hotkeys on each request.
+    validator_permits = dict(
+        zip(metagraph.hotkeys, metagraph.validator_permit.tolist())
+    )
+
     # Check if hotkey is registered.
     my_subnet_uid = 0
     if wallet.hotkey.ss58_address in metagraph.hotkeys:
@@ -166,39 +313,69 @@ def main(config: bt.config):
     )
     thread_generation.start()
 
-    # Connect to SQLite databases.
-    local_storage = threading.local()
+    # Connect to SQLite databases. Each DB has its own pool of connections, shared by all the axon threads.
+    pools = {}
+    pools_lock = threading.Lock()
 
     def close_db_connections():
         """
-        Iterate over all connections in local_storage and close them.
+        Iterate over all connection pools and close them.
         """
-        for attr in dir(local_storage):
-            if attr.startswith("connection_"):
-                connection = getattr(local_storage, attr)
-                connection.close()
-                bt.logging.info(f"Closed database connection: {attr}")
+        with pools_lock:
+            for hotkey in list(pools.keys()):
+                pools.pop(hotkey).close()
+                bt.logging.info(f"Closed database connections: {hotkey}")
 
-    def get_db_connection(allocation: dict) -> sqlite3.Connection:
+    def get_db_pool(allocation: dict) -> SqlitePool:
         """
-        Check if we have a connection for this DB.
+        Check if we have a connection pool for this DB.
 
         Args:
             - allocation (dict): A dictionary containing allocation details.
 
         Returns:
-            - sqlite3.Connection: SQLite connection.
+            - SqlitePool: Pool of SQLite connections.
         """
-        if not hasattr(local_storage, f"connection_{allocation['hotkey']}"):
-            bt.logging.info(
-                f"Connecting to database under path: {allocation['db_path']}"
-            )
-            setattr(
-                local_storage,
-                f"connection_{allocation['hotkey']}",
-                sqlite3.connect(allocation["db_path"]),
-            )
-        return getattr(local_storage, f"connection_{allocation['hotkey']}")
+        with pools_lock:
+            if allocation["hotkey"] not in pools:
+                bt.logging.info(
+                    f"Connecting to database under path: {allocation['db_path']}"
+                )
+                pools[allocation["hotkey"]] = SqlitePool(
+                    allocation["db_path"],
+                    f"DB{allocation['own_hotkey']}{allocation['hotkey']}",
+                    min(config.workers, MAX_READERS),
+                )
+            return pools[allocation["hotkey"]]
+
+    def read_data(allocation: dict, key: int) -> typing.Optional[typing.Tuple[str]]:
+        """
+        Read the data of a key from a DB. It blocks, so the handlers run it in the default executor.
+
+        Args:
+            - allocation (dict): A dictionary containing allocation details.
+            - key (int): The key of the data.
+
+        Returns:
+            - typing.Optional[typing.Tuple[str]]: The row with the data, None if the key is not found.
+        """
+        pool = get_db_pool(allocation)
+        with pool.read() as db:
+            return db.execute(pool.select_sql, (key,)).fetchone()
+
+    def write_data(allocation: dict, key: int, data: str):
+        """
+        Hash and write the data of a key to a DB. It blocks, so the handlers run it in the default executor.
+
+        Args:
+            - allocation (dict): A dictionary containing allocation details.
+            - key (int): The key of the data.
+            - data (str): The data to store.
+        """
+        data_hash = hash_data(data)
+        pool = get_db_pool(allocation)
+        with pool.write() as db:
+            db.execute(pool.update_sql, (data, data_hash, key))
 
     async def ping(synapse: tensorage.protocol.Ping) -> tensorage.protocol.Ping:
         """
@@ -235,15 +412,10 @@ def main(config: bt.config):
                 f"Got RETRIEVE request for key: {synapse.key} from dendrite: {synapse.dendrite.hotkey}"
             )
 
-            # Connect to SQLite databases
-            db = get_db_connection(allocations[synapse.dendrite.hotkey])
-            cursor = db.cursor()
-
-            # Fetch data from SQLite databases
-            cursor.execute(
-                f"SELECT data FROM DB{wallet.hotkey.ss58_address}{synapse.dendrite.hotkey} WHERE id = {synapse.key}"
+            # Fetch data from SQLite databases, off the event loop.
+            data_value = await asyncio.get_running_loop().run_in_executor(
+                None, read_data, allocations[synapse.dendrite.hotkey], synapse.key
             )
-            data_value = cursor.fetchone()
 
             # Set data to None if key not found
             if data_value:
@@ -254,7 +426,8 @@ def main(config: bt.config):
                 synapse.data = None
                 bt.logging.error(f"Data not found for key {synapse.key}!")
 
-        except Exception as e:
+        # The hotkey has no allocation yet, the key doesn't fit in a SQLite integer or the DB can't be read.
+        except (KeyError, OverflowError, sqlite3.Error) as e:
             bt.logging.debug(f"Error retrieving data from db: {e}")
 
         return synapse
@@ -274,30 +447,35 @@ def main(config: bt.config):
             return None
 
         try:
-            # Connect to SQLite DB and insert data into SQLite DB.
-            db = get_db_connection(allocations[synapse.dendrite.hotkey])
-            db.cursor().execute(
-                f"UPDATE DB{wallet.hotkey.ss58_address}{synapse.dendrite.hotkey} SET data = {synapse.data}, hash = {hash_data(synapse.data.encode('utf-8'))} WHERE id = {synapse.key}"
+            # Insert data into SQLite DB, off the event loop.
+            await asyncio.get_running_loop().run_in_executor(
+                None,
+                write_data,
+                allocations[synapse.dendrite.hotkey],
+                synapse.key,
+                synapse.data,
             )
-            db.commit()
 
-        except Exception as e:
+            bt.logging.success(f"Stored data for key {synapse.key}!")
+
+        # The hotkey has no allocation yet, the key doesn't fit in a SQLite integer or the DB can't be written.
+        except (KeyError, OverflowError, sqlite3.Error) as e:
             bt.logging.error(f"Error storing data to db: {e}")
 
         # Return
-        bt.logging.success(f"Stored data for key {synapse.key}!")
         return synapse
 
     # Blacklisting
     def blacklist(synapse: bt.Synapse) -> typing.Tuple[bool, str]:
         # Ignore requests from un-registered entities.
-        if synapse.dendrite.hotkey not in metagraph.hotkeys:
+        validator_permit = validator_permits.get(synapse.dendrite.hotkey)
+        if validator_permit is None:
             bt.logging.trace(
                 f"Blacklisting un-registered hotkey {synapse.dendrite.hotkey}"
             )
             return True, "Unrecognized hotkey"
 
-        if not is_validator(metagraph, synapse.dendrite.hotkey):
+        if not validator_permit:
             bt.logging.warning(
                 f"Blacklisting a request from non-validator hotkey {synapse.dendrite.hotkey}"
             )
@@ -326,6 +504,9 @@ def main(config: bt.config):
     bt.logging.info(f"Starting axon server on port: {config.axon.port}")
     axon.start()
 
+    # Check version in the background and restart PM2 if it's upgraded.
+    check_version_periodically(VERSION_CHECK_TIME)
+
     # The main mining loop.
     step = 0
     bt.logging.info("🚀 Starting miner loop.")
@@ -333,6 +514,9 @@ def main(config: bt.config):
         try:
             # Periodically update our knowledge of the network graph.
             metagraph = subtensor.metagraph(config.netuid)
+            validator_permits = dict(
+                zip(metagraph.hotkeys, metagraph.validator_permit.tolist())
+            )
             bt.logging.info(
                 f"Step:{step} | "
                 f"Block:{metagraph.block.item()} | "
@@ -351,21 +535,43 @@ def main(config: bt.config):
             ):
                 bt.logging.info(f"Reallocating ...")
 
+                # Validators that don't have a DB yet, they take over the DBs of deregistered hotkeys.
+                new_hotkeys = [
+                    hotkey
+                    for hotkey, permit in zip(
+                        metagraph.hotkeys, metagraph.validator_permit.tolist()
+                    )
+                    if permit and hotkey not in allocations
+                ]
+
                 # Update allocations if hotkeys change.
                 for hotkey in list(set(allocations.keys()) - set(metagraph.hotkeys)):
                     bt.logging.info(f"✨ Found new hotkey. Old hokey: {hotkey}.")
 
-                    # Close DB connection.
-                    if hasattr(local_storage, f"connection_{hotkey}"):
-                        connection = getattr(local_storage, f"connection_{hotkey}")
-                        connection.close()
-                        delattr(local_storage, f"connection_{hotkey}")
-                        bt.logging.info(
-                            f"Closed database connection: connection_{hotkey}"
-                        )
+                    # Close DB connections.
+                    with pools_lock:
+                        pool = pools.pop(hotkey, None)
+                    if pool is not None:
+                        pool.close()
+                        bt.logging.info(f"Closed database connections: {hotkey}")
+
+                    # Rename the old DB for a new validator, the generation only has to adjust its size.
+                    if new_hotkeys:
+                        new_hotkey = new_hotkeys.pop()
+                        try:
+                            allocate.reuse_allocation(allocations[hotkey], new_hotkey)
+                            bt.logging.info(
+                                f"Reused database of {hotkey} for new hotkey {new_hotkey}."
+                            )
+                            continue
+
+                        except (sqlite3.Error, OSError) as e:
+                            bt.logging.error(
+                                f"Failed to reuse database of {hotkey}: {e}"
+                            )
 
                     # Delete old DB file.
-                    os.remove(allocations[hotkey]["db_path"])
+                    allocate.remove_db(allocations[hotkey]["db_path"])
 
                 allocations = {
                     a["hotkey"]: a
@@ -397,9 +603,6 @@ def main(config: bt.config):
             bt.logging.info("Keyboard interrupt detected. Exiting miner.")
             exit()
 
-        # Check version and restart PM2 if it's upgraded.
-        check_version()
-
 
 # The main function parses the configuration and runs the miner.
 if __name__ == "__main__":
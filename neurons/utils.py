@@ -19,14 +19,39 @@
 
 import os
 import re
+import json
+import time
+import signal
+import typing
+import hashlib
 import requests
+import tempfile
+import functools
+import threading
 import subprocess
 import bittensor as bt
 
 # Import this repository.
 import tensorage
 
+HASH_BLOCK_SIZE = 1 << 16  # 65536 (64 KB)
 
+# The raw content URL of the file on GitHub.
+VERSION_URL = (
+    "https://raw.githubusercontent.com/tensorage/tensorage/main/tensorage/__init__.py"
+)
+VERSION_PATTERN = re.compile(r'__version__ = "(.*?)"')
+VERSION_CACHE_PATH = os.path.join(
+    os.path.expanduser("~"), ".cache", "tensorage", "version.json"
+)
+VERSION_CACHE_TTL = 300
+VERSION_TIMEOUT = 10
+
+# Reuse the connection to GitHub across version checks.
+session = requests.Session()
+
+
+@functools.lru_cache(maxsize=8)
 def version_str_to_num(version: str) -> int:
     """
     Convert version number as string to number (1.2.0 => 120).
@@ -46,6 +71,26 @@ def version_str_to_num(version: str) -> int:
     )
 
 
+def hash_data(data: typing.Union[bytes, str]) -> str:
+    """
+    Compute the SHA-256 hash of a chunk of data, the same hash the DB generator stores next to each chunk. hashlib uses OpenSSL, which runs on the CPU's SHA extensions when available.
+
+    Args:
+        - data (typing.Union[bytes, str]): The data to hash, a string is hashed as UTF-8.
+
+    Returns:
+        - str: Hexadecimal digest of the data.
+    """
+    if not isinstance(data, str):
+        return hashlib.sha256(data).hexdigest()
+
+    # Encode and hash a string block by block, so a whole encoded copy of a multi-MB chunk is never held in memory.
+    sha256 = hashlib.sha256()
+    for start in range(0, len(data), HASH_BLOCK_SIZE):
+        sha256.update(data[start : start + HASH_BLOCK_SIZE].encode("utf-8"))
+    return sha256.hexdigest()
+
+
 def check_version():
     """
     Check current version of the module on GitHub. If it is greater than the local version, download and update the module.
@@ -53,11 +98,12 @@ def check_version():
     latest_version = get_latest_version()
     current_version = tensorage.__version__
 
+    # If the latest version couldn't be fetched, keep running the current one.
+    if latest_version is None:
+        return
+
     # If version in GitHub is greater, update module.
-    if (
-        version_str_to_num(current_version) < version_str_to_num(latest_version)
-        and latest_version is not None
-    ):
+    if version_str_to_num(current_version) < version_str_to_num(latest_version):
         bt.logging.info("Updating to the latest version...")
         subprocess.run(["git", "reset", "--hard"], cwd=os.getcwd())
         subprocess.run(["git", "pull"], cwd=os.getcwd())
@@ -70,39 +116,123 @@ def check_version():
         exit(0)
 
 
-def get_latest_version() -> str:
+def check_version_periodically(seconds: int) -> threading.Thread:
     """
-    Retrieve latest version number from GitHub repository..
+    Check the version in a background thread every given number of seconds, so the network call never blocks the main loop. If the module is upgraded, the main thread is interrupted as if Ctrl+C was pressed, so it exits and PM2 restarts it.
+
+    Args:
+        - seconds (int): The number of seconds between version checks.
 
     Returns:
-        - str: Version number as string (X.X.X).
+        - threading.Thread: The thread running the version checks.
     """
 
-    # The raw content URL of the file on GitHub.
-    url = "https://raw.githubusercontent.com/tensorage/tensorage/main/tensorage/__init__.py"
+    def run():
+        while True:
+            time.sleep(seconds)
+            try:
+                check_version()
+
+            except SystemExit:
+                os.kill(os.getpid(), signal.SIGINT)
+                return
+
+            except Exception as e:
+                bt.logging.error(f"Failed to check version: {e}")
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
 
-    # Send an HTTP GET request to the raw content URL.
-    response = requests.get(url)
+
+def read_version_cache() -> dict:
+    """
+    Read the cached result of the last version check.
+
+    Returns:
+        - dict: The cached version, its ETag and Last-Modified headers and the time it was fetched. Empty if there is no valid cache.
+    """
+    try:
+        with open(VERSION_CACHE_PATH) as f:
+            cache = json.load(f)
+
+    except (OSError, ValueError):
+        return {}
+
+    return cache if isinstance(cache, dict) else {}
+
+
+def write_version_cache(cache: dict):
+    """
+    Store the result of a version check. The file is replaced atomically, the miner and the validator may share it.
+
+    Args:
+        - cache (dict): The version, its ETag and Last-Modified headers and the time it was fetched.
+    """
+    try:
+        os.makedirs(os.path.dirname(VERSION_CACHE_PATH), exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            "w", dir=os.path.dirname(VERSION_CACHE_PATH), delete=False
+        ) as f:
+            json.dump(cache, f)
+        os.replace(f.name, VERSION_CACHE_PATH)
+
+    except OSError as e:
+        bt.logging.debug(f"Failed to cache version: {e}")
+
+
+def get_latest_version() -> typing.Optional[str]:
+    """
+    Retrieve latest version number from GitHub repository. A version fetched less than VERSION_CACHE_TTL seconds ago is returned from the cache, otherwise the request is conditional and GitHub only sends the file if it changed.
+
+    Returns:
+        - typing.Optional[str]: Version number as string (X.X.X), None if it can't be fetched.
+    """
+    cache = read_version_cache()
+    if (
+        cache.get("version")
+        and time.time() - cache.get("fetched_at", 0) < VERSION_CACHE_TTL
+    ):
+        return cache["version"]
+
+    # Send an HTTP GET request to the raw content URL, with the validators of the cached response.
+    headers = {}
+    if cache.get("version") and cache.get("etag"):
+        headers["If-None-Match"] = cache["etag"]
+    if cache.get("version") and cache.get("last_modified"):
+        headers["If-Modified-Since"] = cache["last_modified"]
+    try:
+        response = session.get(VERSION_URL, headers=headers, timeout=VERSION_TIMEOUT)
+
+    # A slow or unreachable GitHub must not stop the neuron, the version is checked again later.
+    except requests.RequestException as e:
+        bt.logging.error(f"Failed to fetch the latest version: {e}")
+        return None
+
+    # The file didn't change since the cached response.
+    if response.status_code == 304 and cache.get("version"):
+        cache["fetched_at"] = time.time()
+        write_version_cache(cache)
+        return cache["version"]
 
     # Check if the request was successful.
     if response.status_code == 200:
-        version_match = re.search(r'__version__ = "(.*?)"', response.text)
+        version_match = VERSION_PATTERN.search(response.text)
 
         if not version_match:
             raise Exception("Version information not found in the specified line")
 
+        write_version_cache(
+            {
+                "version": version_match.group(1),
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+                "fetched_at": time.time(),
+            }
+        )
         return version_match.group(1)
 
     else:
         bt.logging.error(
             f"Failed to fetch file content. Status code: {response.status_code}"
         )
-
-
-# check whether a certain hotkey is validator or not
-def is_validator(metagraph, hotkey) -> bool:
-    try:
-        uid = metagraph.hotkeys.index(hotkey)
-        return metagraph.validator_permit[uid]
-    except ValueError:
-        return False
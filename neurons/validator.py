@@ -18,27 +18,32 @@
 # DEALINGS IN THE SOFTWARE.
 
 import os
+import re
+import ssl
+import json
 import time
 import torch
+import atexit
+import asyncio
 import shutil
 import typing
 import pickle
 import hashlib
+import pathlib
 import sqlite3
 import argparse
 import traceback
 import bittensor as bt
 import multiprocessing
-from random import randint
 from rich.table import Table
 from contextlib import closing
 from rich.console import Console
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import Future, ThreadPoolExecutor
 
 # Import this repository.
 import allocate
 import tensorage
-from utils import check_version
+from utils import check_version, hash_data
 
 ALPHA = 0.9
 STEP_TIME = 150
@@ -49,6 +54,8 @@ VALIDATION_INCREASING_RATE = 2560  # 10GB
 VALIDATION_DECREASING_RATE = 256  # 1GB
 DEFAULT_TIMEOUT = 12
 DEFAULT_RESPONSE_TIME = 20
+MAX_CONCURRENT_QUERIES = 64
+TABLE_NAME_PATTERN = re.compile(r"DB[A-Za-z0-9]+")
 
 
 def get_config() -> bt.config:
@@ -75,6 +82,12 @@ def get_config() -> bt.config:
         type=int,
         help="The number of concurrent workers to use for hash generation.",
     )
+    parser.add_argument(
+        "--sample_size",
+        default=0,
+        type=int,
+        help="The number of miners to validate at each step, favouring the ones validated least recently. If 0, all of them are validated.",
+    )
     parser.add_argument(
         "--no_store_weights",
         action="store_true",
@@ -114,8 +127,7 @@ def get_config() -> bt.config:
         f"netuid{config.netuid}",
         "validator",
     )
-    if not os.path.exists(config.full_path):
-        os.makedirs(config.full_path, exist_ok=True)
+    os.makedirs(config.full_path, exist_ok=True)
 
     return config
 
@@ -142,11 +154,11 @@ def log_table(
     table.add_column("Hotkey", justify="right", style="cyan")
     table.add_column("N. Chunks", justify="right", style="cyan")
 
-    # Add each row of data.
-    [
-        table.add_row(str(i), str(score), str(hotkeys[i]), str(n_chunks_list[i]))
-        for i, score in enumerate(scores)
-    ]
+    # Add each row of data. The scores are converted to floats at once instead of formatting each tensor element.
+    for i, (score, hotkey, n_chunks) in enumerate(
+        zip(scores.tolist(), hotkeys, n_chunks_list)
+    ):
+        table.add_row(str(i), f"{score:.6f}", hotkey, str(n_chunks))
 
     # Show table in default console.
     console = Console()
@@ -166,6 +178,13 @@ def main(config: bt.config):
         f"Running validator for subnet: {config.netuid} on network: {config.subtensor.chain_endpoint} with config:"
     )
 
+    # The responses of the miners are hashed with OpenSSL, its version tells whether it can use the CPU's SHA extensions.
+    bt.logging.debug(f"Hashing with {ssl.OPENSSL_VERSION}.")
+    if hashlib.sha256.__module__ != "_hashlib":
+        bt.logging.warning(
+            "SHA-256 is not provided by OpenSSL, hashing the responses will be slower."
+        )
+
     # The wallet holds the cryptographic key pairs for the validator.
     wallet = bt.wallet(config=config)
     bt.logging.info(f"Wallet: {wallet}")
@@ -178,6 +197,9 @@ def main(config: bt.config):
     metagraph = subtensor.metagraph(config.netuid)
     bt.logging.info(f"Metagraph: {metagraph}")
 
+    # Map of hotkeys to uids, rebuilt on every metagraph resync to avoid scanning the hotkeys on each lookup.
+    hotkey_uids = {hotkey: uid for uid, hotkey in enumerate(metagraph.hotkeys)}
+
     # Returns current version.
     async def ping(synapse: tensorage.protocol.Ping) -> tensorage.protocol.Ping:
         """
@@ -205,11 +227,11 @@ def main(config: bt.config):
         Returns:
             - tensorage.protocol.Retrieve: Synapse object with ping data.
         """
-        synapse.data = f"I am a validator on SN 7! UID: {metagraph.hotkeys.index(wallet.hotkey.ss58_address)}"
+        synapse.data = f"I am a validator on SN 7! UID: {hotkey_uids.get(wallet.hotkey.ss58_address)}"
         return synapse
 
     # Check if hotkey is registered.
-    if wallet.hotkey.ss58_address not in metagraph.hotkeys:
+    if wallet.hotkey.ss58_address not in hotkey_uids:
         bt.logging.error(
             f"\nYour validator: {wallet} if not registered to chain connection: {subtensor} \nRun btcli register and try again."
         )
@@ -236,6 +258,7 @@ def main(config: bt.config):
     # Set up initial scoring weights for validation.
     bt.logging.info("Building validation weights.")
     scores = torch.ones_like(metagraph.S, dtype=torch.float32)
+    weights = torch.empty_like(scores)
 
     # Set DBs directory.
     wallet_db_path = os.path.join(
@@ -259,16 +282,21 @@ def main(config: bt.config):
                 bt.logging.error(f"Error: {e}")
 
     # Create DBs directory if not exists.
-    if not os.path.exists(
-        wallet_db_path
-    ):  # Ensure the wallet_db_path directory exists.
-        os.makedirs(wallet_db_path, exist_ok=True)
+    os.makedirs(wallet_db_path, exist_ok=True)
 
     # Load previously stored allocations.
     old_allocations = []
+    allocations_json = os.path.join(wallet_db_path, "..", "validator-allocations.json")
     allocations_pkl = os.path.join(wallet_db_path, "..", "validator-allocations.pkl")
     if not config.no_restore_weights:
-        if os.path.exists(allocations_pkl):
+        if os.path.exists(allocations_json):
+            with open(allocations_json) as f:
+                old_allocations = json.load(f)
+
+            bt.logging.success("✅ Successfully restored previously-saved weights.")
+
+        # Allocations stored by a previous version, they are stored as JSON from now on.
+        elif os.path.exists(allocations_pkl):
             with open(allocations_pkl, "rb") as f:
                 old_allocations = pickle.load(f)
 
@@ -283,31 +311,48 @@ def main(config: bt.config):
     # Get the own hotkey from the wallet.
     own_hotkey = wallet.hotkey.ss58_address
 
+    # Path prefix of the DBs, the hotkey of the miner is appended to it.
+    db_path_prefix = os.path.join(wallet_db_path, f"DB-{own_hotkey}-")
+
+    def build_allocation(hotkey: str, n_chunks: int = DEFAULT_N_CHUNKS) -> dict:
+        """
+        Builds the allocation of a miner hotkey.
+
+        Args:
+            - hotkey (str): The hotkey of the miner.
+            - n_chunks (int): The number of chunks of the allocation.
+
+        Returns:
+            - dict: The allocation of the miner.
+        """
+        return {
+            "db_path": f"{db_path_prefix}{hotkey}",
+            "n_chunks": n_chunks,
+            "own_hotkey": own_hotkey,
+            "hotkey": hotkey,
+        }
+
+    # Verified number of chunks of each hotkey in the old allocations.
+    old_n_chunks = {
+        allocation["hotkey"]: max(1, allocation["n_chunks"])
+        for allocation in old_allocations
+    }
+
     # Generate allocations for the validator.
-    allocations = []
+    allocations = [
+        build_allocation(hotkey, old_n_chunks.get(hotkey, DEFAULT_N_CHUNKS))
+        for hotkey in metagraph.hotkeys
+    ]
     response_times = [DEFAULT_RESPONSE_TIME] * len(metagraph.hotkeys)
-    for hotkey in metagraph.hotkeys:
-        # Look for old verified allocations for current hotkey.
-        n_chunks = DEFAULT_N_CHUNKS
-        for allocation in old_allocations:
-            if allocation["hotkey"] == hotkey:
-                n_chunks = max(1, allocation["n_chunks"])
-                break
-
-        allocations.append(
-            {
-                "db_path": os.path.join(wallet_db_path, f"DB-{own_hotkey}-{hotkey}"),
-                "n_chunks": n_chunks,
-                "own_hotkey": own_hotkey,
-                "hotkey": hotkey,
-            }
-        )
 
     # Delete DB if hotkey is not registered.
-    for filename in os.listdir(wallet_db_path):
-        hotkey = filename.replace(f"DB-{own_hotkey}-", "")
-        if hotkey not in metagraph.hotkeys:
-            os.remove(os.path.join(wallet_db_path, filename))
+    with os.scandir(wallet_db_path) as entries:
+        for entry in entries:
+            if entry.is_file(follow_symlinks=False) and (
+                allocate.get_db_hotkey(entry.name, f"DB-{own_hotkey}-")
+                not in hotkey_uids
+            ):
+                os.unlink(entry.path)
 
     # Generate the hash allocations.
     allocate.generate(
@@ -317,42 +362,144 @@ def main(config: bt.config):
         workers=config.workers,
     )
 
-    def validate_allocation(i: int, allocation: dict):
+    # Connections to the hash DBs and their hash query, kept open across steps. They are only used from the main thread, the hashes are read before the miners are queried.
+    connections = {}
+    hash_queries = {}
+
+    def get_db_connection(allocation: dict) -> sqlite3.Connection:
         """
-        Validates how much space each hotkey has allocated.
+        Check if we have a connection for this DB. The hash query of the DB is built along with the connection, the hotkeys in its table name are checked to be alphanumeric first.
 
         Args:
-            - i (int): Index of enumerated list "allocations".
             - allocation (dict): A dictionary containing allocation details.
+
+        Returns:
+            - sqlite3.Connection: SQLite connection.
         """
-        response_times[i] = DEFAULT_RESPONSE_TIME
+        if allocation["db_path"] not in connections:
+            table_name = f"DB{allocation['own_hotkey']}{allocation['hotkey']}"
+            if not TABLE_NAME_PATTERN.fullmatch(table_name):
+                raise ValueError(f"Invalid table name: {table_name}")
+
+            hash_queries[allocation["db_path"]] = (
+                f"SELECT hash FROM {table_name} WHERE id = ?"
+            )
+            # The validator only reads the hashes, the DB is opened read-only so a missing file is an error instead of a new empty DB.
+            connections[allocation["db_path"]] = sqlite3.connect(
+                f"{pathlib.Path(allocation['db_path']).resolve().as_uri()}?mode=ro",
+                uri=True,
+            )
+        return connections[allocation["db_path"]]
+
+    def close_db_connection(db_path: str):
+        """
+        Close the connection to a DB, if there is one.
+
+        Args:
+            - db_path (str): Path to the DB file.
+        """
+        hash_queries.pop(db_path, None)
+        connection = connections.pop(db_path, None)
+        if connection is not None:
+            connection.close()
+
+    def close_db_connections():
+        """
+        Close the connections to all the DBs.
+        """
+        for db_path in list(connections.keys()):
+            close_db_connection(db_path)
+
+    # The connections are kept open between steps, they are closed when the validator exits.
+    atexit.register(close_db_connections)
+
+    def select_chunks() -> typing.List[typing.Optional[int]]:
+        """
+        Select the chunk to request to each miner, the first chunk or a random one among the last VALIDATION_DECREASING_RATE chunks of its allocation.
+
+        Returns:
+            - typing.List[typing.Optional[int]]: The key of the chunk for each allocation, None if the miner is not validated.
+        """
+        # Draw all the keys at once, torch.rand is in [0, 1) so each key is between the lower bound and the last chunk.
+        n_chunks = torch.tensor(
+            [allocation["n_chunks"] for allocation in allocations], dtype=torch.int64
+        )
+        lower_bounds = (n_chunks - VALIDATION_DECREASING_RATE).clamp(min=0)
+        offsets = torch.rand(len(allocations), dtype=torch.float64) * (
+            n_chunks - lower_bounds
+        )
+        keys = lower_bounds + offsets.long()
+        keys[n_chunks < 2] = 0
 
         # Don't self validate and skip 0.0.0.0 axons.
-        if allocation["hotkey"] == own_hotkey or metagraph.axons[i].ip == "0.0.0.0":
-            allocation["n_chunks"] = 0
-            return
+        return [
+            (
+                None
+                if allocation["hotkey"] == own_hotkey
+                or metagraph.axons[i].ip == "0.0.0.0"
+                else key
+            )
+            for i, (allocation, key) in enumerate(zip(allocations, keys.tolist()))
+        ]
+
+    def get_validation_hash(allocation: dict, chunk_i: int) -> typing.Optional[str]:
+        """
+        Get the hash of a chunk from the database.
+
+        Args:
+            - allocation (dict): A dictionary containing allocation details.
+            - chunk_i (int): The key of the chunk.
+
+        Returns:
+            - typing.Optional[str]: The hash of the chunk, None if it can't be read.
+        """
+        try:
+            connection = get_db_connection(allocation)
+            row = connection.execute(
+                hash_queries[allocation["db_path"]], (chunk_i,)
+            ).fetchone()
 
-        # Init hashes to compare.
-        computed_hash = None
-        validation_hash = ""
-
-        # Select first or random chunk to validate.
-        chunk_i = (
-            0
-            if allocation["n_chunks"] < 2
-            else randint(
-                max(0, allocation["n_chunks"] - VALIDATION_DECREASING_RATE),
-                allocation["n_chunks"] - 1,
+        except (ValueError, sqlite3.Error) as e:
+            bt.logging.debug(
+                f"❌ Failed to get validation hash for chunk_{chunk_i} in file {allocation['db_path']}: {e}"
             )
-        )
+            return None
 
-        # Query the miner for the data. TODO: Add timeout param and solve "Timeout context manager should be used inside a task" error.
-        response = bt.dendrite(wallet=wallet).query(
-            metagraph.axons[i],
-            tensorage.protocol.Retrieve(key=chunk_i),
-            timeout=DEFAULT_TIMEOUT,
-            deserialize=False,
-        )
+        if row is None:
+            bt.logging.debug(
+                f"❌ Failed to get validation hash for chunk_{chunk_i} in file {allocation['db_path']}: not found"
+            )
+            return None
+
+        return row[0]
+
+    async def validate_allocation(
+        i: int,
+        allocation: dict,
+        chunk_i: int,
+        validation_hash: typing.Optional[str],
+        semaphore: asyncio.Semaphore,
+    ):
+        """
+        Validates how much space each hotkey has allocated.
+
+        Args:
+            - i (int): Index of enumerated list "allocations".
+            - allocation (dict): A dictionary containing allocation details.
+            - chunk_i (int): The key of the chunk to request.
+            - validation_hash (typing.Optional[str]): The hash of the chunk, None if it can't be read.
+            - semaphore (asyncio.Semaphore): Semaphore that bounds the number of concurrent queries.
+        """
+        response_times[i] = DEFAULT_RESPONSE_TIME
+
+        # Query the miner for the data.
+        async with semaphore:
+            response = await dendrite.forward(
+                metagraph.axons[i],
+                tensorage.protocol.Retrieve(key=chunk_i),
+                timeout=DEFAULT_TIMEOUT,
+                deserialize=False,
+            )
         response_times[i] = response.dendrite.process_time or DEFAULT_RESPONSE_TIME
 
         # Handle time-out
@@ -363,29 +510,42 @@ def main(config: bt.config):
             )
             return
 
-        miner_data = response.data
-        # If the miner can respond with the data, we need to verify it.
-        if miner_data is not None:
-            # Calculate hash of data received.
-            computed_hash = hashlib.sha256(miner_data.encode()).hexdigest()
+        # Hashing the data, reading the DB and generating hashes block, so they run in a worker thread and the event loop keeps waiting for the other miners.
+        await asyncio.get_running_loop().run_in_executor(
+            None,
+            verify_response,
+            i,
+            allocation,
+            chunk_i,
+            validation_hash,
+            response.data,
+        )
 
-            # Get the hash of the data to validate from the database.
-            db = sqlite3.connect(allocation["db_path"])
-            try:
-                validation_hash = (
-                    db.cursor()
-                    .execute(
-                        f"SELECT hash FROM DB{allocation['own_hotkey']}{allocation['hotkey']} WHERE id = {chunk_i}"
-                    )
-                    .fetchone()[0]
-                )
+    def verify_response(
+        i: int,
+        allocation: dict,
+        chunk_i: int,
+        validation_hash: typing.Optional[str],
+        miner_data: typing.Optional[str],
+    ):
+        """
+        Verifies the data a miner responded with and updates its allocation.
 
-            except Exception as e:
-                bt.logging.debug(
-                    f"❌ Failed to get validation hash for chunk_{chunk_i} in file {allocation['db_path']}: {e}"
-                )
+        Args:
+            - i (int): Index of enumerated list "allocations".
+            - allocation (dict): A dictionary containing allocation details.
+            - chunk_i (int): The key of the chunk requested to the miner.
+            - validation_hash (typing.Optional[str]): The hash of the chunk, None if it can't be read.
+            - miner_data (typing.Optional[str]): The data the miner responded with.
+        """
+        # If the miner can respond with the data, we need to verify it.
+        if miner_data is not None:
+            # Without the hash of the chunk, the response can't be verified.
+            if validation_hash is None:
                 return
-            db.close()
+
+            # Calculate hash of data received.
+            computed_hash = hash_data(miner_data)
 
             # Check if the miner has provided the correct response.
             if computed_hash == validation_hash:
@@ -394,7 +554,7 @@ def main(config: bt.config):
                 bt.logging.success(
                     f"✅ Miner [uid {i}] provided correct chunk_{chunk_i}. Increasing allocation to: {allocation['n_chunks']}."
                 )
-                allocate.run_rust_generate(allocation, only_hash=True)
+                grown_allocations.append(dict(allocation))
 
             else:
                 # The miner has provided an incorrect response. We need to decrease our estimation.
@@ -408,23 +568,144 @@ def main(config: bt.config):
                 f"❌ Miner [uid {i}] has not provided response for key {chunk_i}. Reducing allocation to: {allocation['n_chunks']}."
             )
 
+    # Hashes are generated in a background thread, the Rust generator runs while the validator waits for the next step.
+    generation_executor = ThreadPoolExecutor(max_workers=1)
+    grown_allocations = []
+
+    def generate_in_background(
+        allocations_to_generate: typing.List[dict],
+    ) -> typing.Optional[Future]:
+        """
+        Generate the hashes of some allocations in the background.
+
+        Args:
+            - allocations_to_generate (typing.List[dict]): The allocations to generate.
+
+        Returns:
+            - typing.Optional[Future]: The future of the generation, None if there is nothing to generate.
+        """
+        if not allocations_to_generate:
+            return None
+
+        return generation_executor.submit(
+            allocate.generate,
+            allocations=list(allocations_to_generate),
+            disable_prompt=True,
+            only_hash=True,
+            workers=config.workers,
+        )
+
+    def wait_for_generation(generation: typing.Optional[Future]):
+        """
+        Wait for a background generation to finish.
+
+        Args:
+            - generation (typing.Optional[Future]): The future of the generation.
+        """
+        if generation is None:
+            return
+
+        try:
+            generation.result()
+
+        except Exception as e:
+            bt.logging.error(f"Failed to generate hashes: {e}")
+
+    # The step at which each hotkey was last validated, used to sample the allocations.
+    last_validated = {}
+
+    def sample_allocations(
+        chunks: typing.List[typing.Optional[int]],
+    ) -> typing.List[int]:
+        """
+        Select the allocations to validate at this step among the ones that can be queried. By default all of them, with --sample_size only that many, drawn with a probability proportional to the number of steps since they were last validated.
+
+        Args:
+            - chunks (typing.List[typing.Optional[int]]): The key of the chunk for each allocation, None if the miner is not validated.
+
+        Returns:
+            - typing.List[int]: Indexes of enumerated list "allocations".
+        """
+        indexes = [i for i, chunk_i in enumerate(chunks) if chunk_i is not None]
+        if config.sample_size <= 0 or config.sample_size >= len(indexes):
+            return indexes
+
+        # The allocations that can't be queried have no weight, so they never take a slot of the sample.
+        staleness = torch.tensor(
+            [
+                (
+                    0
+                    if chunk_i is None
+                    else step - last_validated.get(allocation["hotkey"], 0) + 1
+                )
+                for allocation, chunk_i in zip(allocations, chunks)
+            ],
+            dtype=torch.float64,
+        )
+        indexes = sorted(
+            torch.multinomial(staleness, config.sample_size, replacement=False).tolist()
+        )
+        for i in indexes:
+            last_validated[allocations[i]["hotkey"]] = step
+        return indexes
+
+    async def validate_allocations():
+        """
+        Validates the allocations concurrently.
+        """
+        # Select all the chunks and read their hashes up front, each DB is read once per step and no query waits on the network.
+        chunks = select_chunks()
+
+        # Don't self validate and skip 0.0.0.0 axons, their allocation is reset without scheduling a query.
+        for i, chunk_i in enumerate(chunks):
+            if chunk_i is None:
+                allocations[i]["n_chunks"] = 0
+                response_times[i] = DEFAULT_RESPONSE_TIME
+        indexes = sample_allocations(chunks)
+
+        validation_hashes = {
+            i: get_validation_hash(allocations[i], chunks[i]) for i in indexes
+        }
+
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_QUERIES)
+        results = await asyncio.gather(
+            *[
+                validate_allocation(
+                    i, allocations[i], chunks[i], validation_hashes[i], semaphore
+                )
+                for i in indexes
+            ],
+            return_exceptions=True,
+        )
+
+        # A failed validation doesn't stop the others, but it must not go unnoticed.
+        for i, result in zip(indexes, results):
+            if isinstance(result, Exception):
+                bt.logging.error(f"❌ Failed to validate miner [uid {i}]: {result}")
+
+    # The dendrite and its connections are bound to an event loop, so the same loop is used for every step.
+    dendrite = bt.dendrite(wallet=wallet)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
     # The main validation Loop.
     step = 0
+    stored_allocations = None
+    generation = None
     bt.logging.info("🚀 Starting validator loop.")
     while True:
         try:
             # Prepare for the next iteration.
             step += 1
 
-            # Measure the time it takes to validate all the miners running on the subnet.
+            # Measure the time it takes to validate all the miners running on the subnet, the rest of the step is spent waiting.
             start_time = time.time()
 
+            # The hashes to validate must be generated before they are read.
+            wait_for_generation(generation)
+
             # Iterate over all hotkeys on the network and validate them.
-            with ThreadPoolExecutor(max_workers=config.workers) as executor:
-                [
-                    executor.submit(validate_allocation, i, allocation)
-                    for i, allocation in enumerate(allocations)
-                ]
+            loop.run_until_complete(validate_allocations())
 
             # Log the time it took to validate all miners.
             elapsed_time = round(time.time() - start_time)
@@ -432,9 +713,12 @@ def main(config: bt.config):
                 f"Finished validation step {step} in {elapsed_time} seconds."
             )
 
-            if not config.no_store_weights:  # Save verified allocations.
-                with open(allocations_pkl, "wb") as f:
-                    pickle.dump(allocations, f)
+            # Save verified allocations, only if they changed since they were last stored. They are written to a temporary file that replaces the old one, so a crash never leaves a truncated file.
+            if not config.no_store_weights and allocations != stored_allocations:
+                with open(f"{allocations_json}.tmp", "w") as f:
+                    json.dump(allocations, f, separators=(",", ":"))
+                os.replace(f"{allocations_json}.tmp", allocations_json)
+                stored_allocations = [dict(allocation) for allocation in allocations]
                 bt.logging.success(
                     "✅ Successfully stored verified allocations locally."
                 )
@@ -445,21 +729,17 @@ def main(config: bt.config):
                 # # Create a new artifact with timestamp
                 # artifact = wandb.Artifact(f'allocations_{int(time.time())}', type='dataset')
                 # # Add the file to the artifact
-                # artifact.add_file(allocations_pkl)
+                # artifact.add_file(allocations_json)
                 # # Log the artifact
                 # run.log_artifact(artifact)
                 # bt.logging.success("✅ Successfully stored verified allocations on wandb.")
 
-            # Wait for validate again.
-            seconds_to_wait = STEP_TIME - elapsed_time
-            if seconds_to_wait > 0:
-                bt.logging.info(f"Waiting {seconds_to_wait} seconds for the next step.")
-                time.sleep(seconds_to_wait)
-
             # Resync our local state with the latest state from the blockchain.
             metagraph = subtensor.metagraph(config.netuid)
+            hotkey_uids = {hotkey: uid for uid, hotkey in enumerate(metagraph.hotkeys)}
 
-            # Update allocations if hotkey of uid change.
+            # Update allocations if hotkey of uid change. No generation is running since the start of the step, so the DBs of old hotkeys can be deleted.
+            new_allocations = []
             for i, hotkey in enumerate(metagraph.hotkeys):
                 if i < len(allocations):
                     # No hotkey change for this uid.
@@ -469,63 +749,67 @@ def main(config: bt.config):
                     # Old hotkey was deregistered and new hotkey registered on this uid so reset the allocation for this uid.
                     bt.logging.info(f"✨ Found new hotkey: {hotkey}.")
 
-                    # Delete old DB file.
-                    os.remove(allocations[i]["db_path"])
+                    # Close the connection and delete old DB file.
+                    close_db_connection(allocations[i]["db_path"])
+                    allocate.remove_db(allocations[i]["db_path"])
 
                     # Generate new allocation.
-                    db_path = os.path.join(wallet_db_path, f"DB-{own_hotkey}-{hotkey}")
-                    allocations[i] = {
-                        "db_path": db_path,
-                        "n_chunks": DEFAULT_N_CHUNKS,
-                        "own_hotkey": own_hotkey,
-                        "hotkey": hotkey,
-                    }
+                    allocations[i] = build_allocation(hotkey)
                 else:  # If new hotkey has been added to metagraph (not all 256 slots are filled up)
                     bt.logging.info(f"✨ Found new hotkey {hotkey} at uid {i}:")
-                    allocations.append(
-                        {
-                            "db_path": os.path.join(
-                                wallet_db_path, f"DB-{own_hotkey}-{hotkey}"
-                            ),
-                            "n_chunks": DEFAULT_N_CHUNKS,
-                            "own_hotkey": own_hotkey,
-                            "hotkey": hotkey,
-                        }
-                    )
+                    allocations.append(build_allocation(hotkey))
                     response_times.append(DEFAULT_RESPONSE_TIME)
 
-                allocate.run_rust_generate(allocations[i], only_hash=True)
+                new_allocations.append(dict(allocations[i]))
+
+            # Generate the hashes of the grown and new allocations while waiting for the next step, except the grown ones whose hotkey was just replaced.
+            generation = generate_in_background(
+                [
+                    allocation
+                    for allocation in grown_allocations
+                    if allocation["hotkey"] in hotkey_uids
+                ]
+                + new_allocations
+            )
+            grown_allocations.clear()
 
             # Periodically update the weights on the Bittensor blockchain.
             if step % int(SCORES_TIME / STEP_TIME) == 0:
                 max_time = max(response_times)
                 min_time = min(response_times)
                 # Calculate score with n_chunks of allocations.
-                for index, uid in enumerate(metagraph.uids):
-                    try:
-                        allocation_index = next(
-                            i
-                            for i, obj in enumerate(allocations)
-                            if obj["hotkey"] == metagraph.neurons[uid].axon_info.hotkey
-                        )
-                        chunks = allocations[allocation_index]["n_chunks"]
-                        seconds = response_times[allocation_index]
-
-                    except StopIteration:
-                        chunks = 0
-                        seconds = max_time
-
-                    time_reward = (
-                        (seconds - min_time) / (max_time - min_time)
-                        if max_time != min_time
-                        else 1
-                    ) + 1
-                    score = chunks / time_reward if time_reward > 0 else chunks
-
-                    scores[index] = ALPHA * scores[index] + (1 - ALPHA) * score
+                allocation_indexes = {
+                    allocation["hotkey"]: i for i, allocation in enumerate(allocations)
+                }
+                chunks = []
+                seconds = []
+                for hotkey in metagraph.hotkeys:
+                    allocation_index = allocation_indexes.get(hotkey)
+                    if allocation_index is not None:
+                        chunks.append(allocations[allocation_index]["n_chunks"])
+                        seconds.append(response_times[allocation_index])
+
+                    else:
+                        chunks.append(0)
+                        seconds.append(max_time)
+
+                # Score all the uids at once, the time reward goes from 1 for the fastest miner to 2 for the slowest one.
+                chunks = torch.tensor(chunks, dtype=torch.float32)
+                seconds = torch.tensor(seconds, dtype=torch.float32)
+                time_reward = (
+                    (seconds - min_time) / (max_time - min_time)
+                    if max_time != min_time
+                    else torch.ones_like(seconds)
+                ) + 1
+
+                # The scores and weights buffers grow with the metagraph, new uids start with the initial score.
+                if len(scores) < len(chunks):
+                    scores = torch.cat((scores, torch.ones(len(chunks) - len(scores))))
+                    weights = torch.empty_like(scores)
+                scores.mul_(ALPHA).add_(chunks / time_reward, alpha=1 - ALPHA)
 
                 # TODO: Define how the validator normalizes scores before setting weights.
-                weights = torch.nn.functional.normalize(scores, p=1.0, dim=0)
+                torch.div(scores, scores.abs().sum().clamp(min=1e-12), out=weights)
                 bt.logging.info("Setting weights:")
                 log_table(
                     scores=weights,
@@ -547,6 +831,12 @@ def main(config: bt.config):
                 else:
                     bt.logging.error("❌  Failed to set weights.")
 
+            # Wait for validate again.
+            seconds_to_wait = round(STEP_TIME - (time.time() - start_time))
+            if seconds_to_wait > 0:
+                bt.logging.info(f"Waiting {seconds_to_wait} seconds for the next step.")
+                time.sleep(seconds_to_wait)
+
         # If we encounter an unexpected error, log it for debugging.
         except RuntimeError as e:
             bt.logging.error(e)
@@ -555,6 +845,9 @@ def main(config: bt.config):
         # If the user interrupts the program, gracefully exit.
         except KeyboardInterrupt:
             axon.stop()
+            close_db_connections()
+            loop.run_until_complete(dendrite.aclose_session())
+            loop.close()
             bt.logging.info("Keyboard interrupt detected. Exiting validator.")
             exit()
 